@@ -4,8 +4,11 @@
 import numpy as np
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import SubsetRandomSampler
 
+from utils.distributed import get_rank, get_world_size, is_distributed
+
 
 # ------------------------------------------------------------------------------
 #   BaseDataLoader
@@ -24,9 +27,12 @@ class BaseDataLoader(DataLoader):
         self.shuffle = shuffle
 
         self.batch_idx = 0
+        self.epoch = 0
         self.n_samples = len(dataset)
 
-        self.sampler, self.valid_sampler = self._split_sampler(self.validation_split)
+        self.sampler, self.valid_sampler = self._split_sampler(
+            self.validation_split, dataset
+        )
 
         self.init_kwargs = {
             "dataset": dataset,
@@ -37,9 +43,27 @@ class BaseDataLoader(DataLoader):
         }
         super(BaseDataLoader, self).__init__(sampler=self.sampler, **self.init_kwargs)
 
-    def _split_sampler(self, split):
+    def __iter__(self):
+        # reshuffle DistributedSampler differently on every pass
+        if isinstance(self.sampler, DistributedSampler):
+            self.sampler.set_epoch(self.epoch)
+            self.epoch += 1
+        return super(BaseDataLoader, self).__iter__()
+
+    def _split_sampler(self, split, dataset):
         if split == 0.0:
-            return None, None
+            if not is_distributed():
+                return None, None
+            # each rank iterates its own shard of the dataset
+            sampler = DistributedSampler(
+                dataset,
+                num_replicas=get_world_size(),
+                rank=get_rank(),
+                shuffle=self.shuffle,
+            )
+            self.shuffle = False
+            self.n_samples = sampler.num_samples
+            return sampler, None
 
         idx_full = np.arange(self.n_samples)
 
@@ -51,6 +75,11 @@ class BaseDataLoader(DataLoader):
         valid_idx = idx_full[0:len_valid]
         train_idx = np.delete(idx_full, np.arange(0, len_valid))
 
+        # the split is seeded, so every rank can take a disjoint shard of it
+        if is_distributed():
+            train_idx = self._shard_indices(train_idx)
+            valid_idx = self._shard_indices(valid_idx)
+
         train_sampler = SubsetRandomSampler(train_idx)
         valid_sampler = SubsetRandomSampler(valid_idx)
 
@@ -60,6 +89,16 @@ class BaseDataLoader(DataLoader):
 
         return train_sampler, valid_sampler
 
+    @staticmethod
+    def _shard_indices(idx):
+        # pad to a multiple of world_size, as DistributedSampler does, so every
+        # rank runs the same number of batches and DDP allreduces stay matched
+        world_size = get_world_size()
+        padding = -len(idx) % world_size
+        if padding:
+            idx = np.concatenate([idx, np.resize(idx, padding)])
+        return idx[get_rank() :: world_size]
+
     def split_validation(self):
         if self.valid_sampler is None:
             return None
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 import torchsummary
 
+from utils.checkpoint import load_checkpoint
 from utils.flops_counter import add_flops_counting_methods, flops_to_string
 
 
@@ -52,7 +53,7 @@ class BaseModel(nn.Module):
                 "[%s] Load pretrained model from %s"
                 % (self.__class__.__name__, pretrained)
             )
-            pretrain_dict = torch.load(pretrained, map_location="cpu")
+            pretrain_dict = load_checkpoint(pretrained, map_location="cpu")
             if "state_dict" in pretrain_dict:
                 pretrain_dict = pretrain_dict["state_dict"]
         elif isinstance(pretrained, dict):
@@ -97,7 +98,7 @@ class BaseBackbone(BaseModel):
                 "[%s] Load pretrained model from %s"
                 % (self.__class__.__name__, pretrained)
             )
-            pretrain_dict = torch.load(pretrained, map_location="cpu")
+            pretrain_dict = load_checkpoint(pretrained, map_location="cpu")
             if "state_dict" in pretrain_dict:
                 pretrain_dict = pretrain_dict["state_dict"]
         elif isinstance(pretrained, dict):
@@ -1,17 +1,31 @@
 # ------------------------------------------------------------------------------
 #   Libraries
 # ------------------------------------------------------------------------------
+import copy
 import datetime
-import json
 import logging
 import math
 import os
+import queue
+import threading
+from collections import OrderedDict
 from time import time
 
+import orjson
 import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 
+from utils.checkpoint import load_checkpoint, save_checkpoint
+from utils.distributed import get_local_rank, is_distributed, is_main_process
 from utils.visualization import WriterTensorboardX
 
+# Gradient compression applied to DDP allreduces, see config['trainer']['ddp_comm_hook']
+DDP_COMM_HOOKS = {
+    "none": None,
+    "fp16": default_hooks.fp16_compress_hook,
+    "bf16": default_hooks.bf16_compress_hook,
+}
 
 # ------------------------------------------------------------------------------
 #   Class of BaseTrainer
@@ -26,29 +40,46 @@ class BaseTrainer:
     ):
         self.config = config
 
+        # Only rank 0 writes logs, tensorboard events and checkpoints
+        self.is_main_process = is_main_process()
+
         # Setup directory for checkpoint saving
         start_time = datetime.datetime.now().strftime("%m%d_%H%M%S")
         self.checkpoint_dir = os.path.join(
             config["trainer"]["save_dir"], config["name"], start_time
         )
-        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if self.is_main_process:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
 
         # Setup logger
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s %(message)s",
-            handlers=[
-                logging.FileHandler(os.path.join(self.checkpoint_dir, "train.log")),
-                logging.StreamHandler(),
-            ],
-        )
+        if self.is_main_process:
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s %(message)s",
+                handlers=[
+                    logging.FileHandler(os.path.join(self.checkpoint_dir, "train.log")),
+                    logging.StreamHandler(),
+                ],
+            )
+        else:
+            logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
         self.logger = logging.getLogger(self.__class__.__name__)
 
         # Setup GPU device if available, move model into configured device
         self.device, device_ids = self._prepare_device(config["n_gpu"])
         self.model = model.to(self.device)
-        if len(device_ids) > 1:
-            self.model = torch.nn.DataParallel(model, device_ids=device_ids)
+        if is_distributed():
+            self.model = torch.nn.parallel.DistributedDataParallel(
+                self.model,
+                device_ids=device_ids,
+                bucket_cap_mb=25,
+                gradient_as_bucket_view=True,
+                # the set of used parameters never changes between iterations
+                static_graph=True,
+            )
+            comm_hook = DDP_COMM_HOOKS[config["trainer"].get("ddp_comm_hook", "fp16")]
+            if comm_hook is not None:
+                self.model.register_comm_hook(state=None, hook=comm_hook)
 
         self.loss = loss
         self.metrics = metrics
@@ -60,6 +91,25 @@ class BaseTrainer:
 
         self.train_logger = train_logger
 
+        # Setup asynchronous checkpointing: tensors are staged into
+        # double-buffered pinned host memory on a side stream, then a
+        # background thread writes them while training continues.
+        self._checkpoint_stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+        self._staging_buffers = [{}, {}]
+        self._staging_free = [threading.Event() for _ in self._staging_buffers]
+        for free in self._staging_free:
+            free.set()
+        self._staging_idx = 0
+        self._save_plan = None
+        self._flush_error = None
+        self._flush_queue = queue.Queue(maxsize=1)
+        self._flush_thread = threading.Thread(target=self._flush_worker, daemon=True)
+        self._flush_thread.start()
+
         # configuration to monitor model performance and save best
         self.monitor = config["trainer"]["monitor"]
         self.monitor_mode = config["trainer"]["monitor_mode"]
@@ -74,17 +124,19 @@ class BaseTrainer:
         writer_valid_dir = os.path.join(
             config["visualization"]["log_dir"], config["name"], start_time, "valid"
         )
+        enable_writer = config["visualization"]["tensorboardX"] and self.is_main_process
         self.writer_train = WriterTensorboardX(
-            writer_train_dir, self.logger, config["visualization"]["tensorboardX"]
+            writer_train_dir, self.logger, enable_writer
         )
         self.writer_valid = WriterTensorboardX(
-            writer_valid_dir, self.logger, config["visualization"]["tensorboardX"]
+            writer_valid_dir, self.logger, enable_writer
         )
 
         # Save configuration file into checkpoint directory
-        config_save_path = os.path.join(self.checkpoint_dir, "config.json")
-        with open(config_save_path, "w") as handle:
-            json.dump(config, handle, indent=4, sort_keys=False)
+        if self.is_main_process:
+            config_save_path = os.path.join(self.checkpoint_dir, "config.json")
+            with open(config_save_path, "wb") as handle:
+                handle.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
 
         # Resume
         if resume:
@@ -93,7 +145,24 @@ class BaseTrainer:
     def _prepare_device(self, n_gpu_use):
         """
         setup GPU device if available, move model into configured device
+
+        Multi-GPU training runs one process per GPU under DistributedDataParallel;
+        launch with torchrun (or torch.multiprocessing.spawn setting RANK,
+        LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT) to use it.
         """
+        if is_distributed():
+            if not torch.cuda.is_available():
+                raise RuntimeError("Distributed training requires CUDA devices")
+            local_rank = get_local_rank()
+            torch.cuda.set_device(local_rank)
+            if not dist.is_initialized():
+                options = dist.ProcessGroupNCCL.Options()
+                options.is_high_priority_stream = True
+                dist.init_process_group(
+                    backend="nccl", init_method="env://", pg_options=options
+                )
+            return torch.device("cuda", local_rank), [local_rank]
+
         n_gpu = torch.cuda.device_count()
         if n_gpu_use > 0 and n_gpu == 0:
             self.logger.warning(
@@ -106,11 +175,31 @@ class BaseTrainer:
             )
             self.logger.warning(msg)
             n_gpu_use = n_gpu
+        if n_gpu_use > 1:
+            self.logger.warning(
+                "Warning: {} GPU's configured, but this is a single process; launch with torchrun to train on multiple GPU's.".format(
+                    n_gpu_use
+                )
+            )
+            n_gpu_use = 1
         device = torch.device("cuda:0" if n_gpu_use > 0 else "cpu")
         list_ids = list(range(n_gpu_use))
         return device, list_ids
 
     def train(self):
+        try:
+            self._train_epochs()
+        except BaseException:
+            # Let in-flight checkpoints finish before the exception unwinds to
+            # interpreter shutdown, which would kill the flush thread mid-write;
+            # flush errors were already logged by the flush thread.
+            self._flush_queue.join()
+            raise
+
+        # Wait for in-flight checkpoints to reach the disk
+        self._wait_for_checkpoints()
+
+    def _train_epochs(self):
         for epoch in range(self.start_epoch, self.epochs + 1):
             self.logger.info(
                 "\n----------------------------------------------------------------"
@@ -194,41 +283,200 @@ class BaseTrainer:
         """
         Saving checkpoints
 
+        Tensors are staged to pinned host memory and written to disk by a
+        background thread; see _stage_state() and _flush_state().
+
         :param epoch: current epoch number
-        :param log: logging information of the epoch
         :param save_best: if True, rename the saved checkpoint to 'model_best.pth'
         """
-        # Construct savedict
-        arch = type(self.model).__name__
-        state = {
-            "arch": arch,
-            "epoch": epoch,
-            "logger": self.train_logger,
-            "state_dict": self.model.state_dict(),
-            "optimizer": self.optimizer.state_dict(),
-            "monitor_best": self.monitor_best,
-            "config": self.config,
-        }
+        if is_distributed() and self.monitor_mode != "off":
+            save_best = self._sync_monitor_best(save_best)
+        if not self.is_main_process:
+            return
+
+        if self._flush_error is not None:
+            error, self._flush_error = self._flush_error, None
+            raise RuntimeError("Previous checkpoint flush failed") from error
+
+        filenames = []
 
         # Save checkpoint for each epoch
         if (
             self.save_freq is not None
         ):  # Use None mode to avoid over disk space with large models
             if epoch % self.save_freq == 0:
-                filename = os.path.join(
-                    self.checkpoint_dir, "epoch{}.pth".format(epoch)
+                filenames.append(
+                    os.path.join(self.checkpoint_dir, "epoch{}.pth".format(epoch))
                 )
-                torch.save(state, filename)
-                self.logger.info("Saving checkpoint at {}".format(filename))
 
         # Save the best checkpoint
         if save_best:
-            best_path = os.path.join(self.checkpoint_dir, "model_best.pth")
-            torch.save(state, best_path)
-            self.logger.info("Saving current best at {}".format(best_path))
+            filenames.append(os.path.join(self.checkpoint_dir, "model_best.pth"))
         else:
             self.logger.info("Monitor is not improved from %f" % (self.monitor_best))
 
+        if not filenames:
+            return
+
+        # Construct savedict
+        arch = type(self.model).__name__
+        state = {
+            "arch": arch,
+            "epoch": epoch,
+            "logger": self.train_logger,
+            "state_dict": self._model_state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "monitor_best": self.monitor_best,
+            "config": self.config,
+        }
+
+        idx, cpu_state, event = self._stage_state(state)
+        self._flush_queue.put((idx, cpu_state, event, filenames), block=True)
+
+    def _sync_monitor_best(self, save_best):
+        """
+        Agree on monitor_best and save_best across ranks
+
+        Each rank monitors metrics of its own data shard, so the best value is
+        reduced with MIN/MAX per monitor_mode, and the best checkpoint is saved
+        if any rank improved.
+
+        :param save_best: whether this rank's monitor improved
+        :return: whether any rank's monitor improved
+        """
+        op = dist.ReduceOp.MIN if self.monitor_mode == "min" else dist.ReduceOp.MAX
+        best = torch.tensor(self.monitor_best, dtype=torch.float64, device=self.device)
+        dist.all_reduce(best, op=op)
+        self.monitor_best = best.item()
+
+        improved = torch.tensor(int(save_best), device=self.device)
+        dist.all_reduce(improved, op=dist.ReduceOp.MAX)
+        return bool(improved.item())
+
+    def _model_state_dict(self):
+        """
+        Model state_dict built from a cached save plan
+
+        The (key, tensor) plan is collected once with keep_vars=True, so it
+        holds the live parameters and buffers; later checkpoints skip the
+        module tree walk and only rebuild the flat dict. Module.to() and
+        friends can swap tensors out of a module, so the plan is rebuilt
+        whenever a cached tensor is no longer the one its module holds.
+        """
+        if self._save_plan is None or not self._save_plan_is_current():
+            state_dict = self.model.state_dict(keep_vars=True)
+            slots = []
+            for key, tensor in state_dict.items():
+                prefix, _, name = key.rpartition(".")
+                slots.append((self.model.get_submodule(prefix), name, tensor))
+            self._save_plan = (
+                list(state_dict.items()),
+                getattr(state_dict, "_metadata", None),
+                slots,
+            )
+        items, metadata, _ = self._save_plan
+        state_dict = OrderedDict(items)
+        if metadata is not None:
+            state_dict._metadata = metadata
+        return state_dict
+
+    def _save_plan_is_current(self):
+        for module, name, tensor in self._save_plan[2]:
+            current = module._parameters.get(name)
+            if current is None:
+                current = module._buffers.get(name)
+            if current is not tensor:
+                return False
+        return True
+
+    def _stage_state(self, state):
+        """
+        Copy a checkpoint state into a free pinned staging buffer
+
+        Device tensors are copied with non_blocking transfers on the
+        checkpoint stream; everything else is deep-copied so later epochs
+        can't mutate it while it is being flushed.
+
+        :param state: checkpoint dict to stage
+        :return: (staging slot index, staged state, completion event or None)
+        """
+        idx = self._staging_idx
+        self._staging_idx = (idx + 1) % len(self._staging_buffers)
+
+        # Block only if this slot's previous flush is still in-flight
+        self._staging_free[idx].wait()
+        self._staging_free[idx].clear()
+        buffers = self._staging_buffers[idx]
+        pin_memory = self._checkpoint_stream is not None
+
+        def stage(key, obj):
+            if isinstance(obj, torch.Tensor):
+                buf = buffers.get(key)
+                if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                    buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin_memory)
+                    buffers[key] = buf
+                buf.copy_(obj.detach(), non_blocking=True)
+                return buf
+            if isinstance(obj, dict):
+                staged = type(obj)((k, stage(key + (k,), v)) for k, v in obj.items())
+                if hasattr(obj, "_metadata"):
+                    staged._metadata = copy.deepcopy(obj._metadata)
+                return staged
+            if isinstance(obj, (list, tuple)):
+                return type(obj)(stage(key + (i,), v) for i, v in enumerate(obj))
+            return copy.deepcopy(obj)
+
+        if self._checkpoint_stream is None:
+            return idx, stage((), state), None
+
+        main_stream = torch.cuda.current_stream(self.device)
+        self._checkpoint_stream.wait_stream(main_stream)
+        with torch.cuda.stream(self._checkpoint_stream):
+            cpu_state = stage((), state)
+            event = torch.cuda.Event()
+            event.record(self._checkpoint_stream)
+        # Keep the next optimizer step from overwriting tensors mid-copy
+        main_stream.wait_stream(self._checkpoint_stream)
+        return idx, cpu_state, event
+
+    def _flush_state(self, idx, cpu_state, event, filenames):
+        """
+        Write a staged checkpoint to disk, then release its staging slot
+
+        :param idx: staging slot index returned by _stage_state()
+        :param cpu_state: staged checkpoint dict
+        :param event: CUDA event marking the end of the staging copies, or None
+        :param filenames: paths to write the checkpoint to
+        """
+        try:
+            if event is not None:
+                event.synchronize()
+            for filename in filenames:
+                save_checkpoint(cpu_state, filename)
+                self.logger.info("Saving checkpoint at {}".format(filename))
+        finally:
+            self._staging_free[idx].set()
+
+    def _flush_worker(self):
+        while True:
+            job = self._flush_queue.get()
+            try:
+                self._flush_state(*job)
+            except Exception as e:
+                self.logger.exception("Checkpoint flush failed")
+                self._flush_error = e
+            finally:
+                self._flush_queue.task_done()
+
+    def _wait_for_checkpoints(self):
+        """
+        Block until every queued checkpoint has been written
+        """
+        self._flush_queue.join()
+        if self._flush_error is not None:
+            error, self._flush_error = self._flush_error, None
+            raise RuntimeError("Checkpoint flush failed") from error
+
     def _resume_checkpoint(self, resume_path):
         """
         Resume from saved checkpoints
@@ -236,7 +484,9 @@ class BaseTrainer:
         :param resume_path: Checkpoint path to be resumed
         """
         self.logger.info("Loading checkpoint: {}".format(resume_path))
-        checkpoint = torch.load(resume_path)
+        # tensors stay memory-mapped on the CPU until load_state_dict copies
+        # them into the model's device
+        checkpoint = load_checkpoint(resume_path, map_location="cpu")
         self.start_epoch = checkpoint["epoch"] + 1
         self.monitor_best = checkpoint["monitor_best"]
 
@@ -2,10 +2,13 @@
 #  Libraries
 # ------------------------------------------------------------------------------
 import math
-from functools import reduce
 
 import torch
 import torch.nn as nn
+from torch.ao.quantization import fuse_modules, get_default_qconfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from utils.checkpoint import load_checkpoint
 
 
 # ------------------------------------------------------------------------------
@@ -157,20 +160,8 @@ class MobileNetV2(nn.Module):
         self._init_weights()
 
     def forward(self, x, feature_names=None):
-        # Stage1
-        x = reduce(lambda x, n: self.features[n](x), list(range(0, 2)), x)
-
-        # Stage2
-        x = reduce(lambda x, n: self.features[n](x), list(range(2, 4)), x)
-
-        # Stage3
-        x = reduce(lambda x, n: self.features[n](x), list(range(4, 7)), x)
-
-        # Stage4
-        x = reduce(lambda x, n: self.features[n](x), list(range(7, 14)), x)
-
-        # Stage5
-        x = reduce(lambda x, n: self.features[n](x), list(range(14, 19)), x)
+        # Stage1-5: features[0:2], [2:4], [4:7], [7:14], [14:19] run back to back
+        x = self.features(x)
 
         # Classification
         if self.num_classes is not None:
@@ -180,8 +171,41 @@ class MobileNetV2(nn.Module):
         # Output
         return x
 
+    @classmethod
+    def quantize(
+        cls, calibration_batches, pretrained_file=None, backend="fbgemm", **kwargs
+    ):
+        """
+        Build an int8 post-training-quantized MobileNetV2 for CPU inference
+
+        :param calibration_batches: iterable of representative float input
+            batches used to calibrate activation ranges
+        :param pretrained_file: optional weights to load before quantizing
+        :param backend: quantized engine, 'fbgemm' (x86) or 'qnnpack' (ARM)
+        :param kwargs: forwarded to the MobileNetV2 constructor
+        :return: quantized torch.fx.GraphModule
+        """
+        model = cls(**kwargs)
+        if pretrained_file is not None:
+            model._load_pretrained_model(pretrained_file)
+        model.eval().fuse_for_inference()
+
+        torch.backends.quantized.engine = backend
+        model = prepare_fx(model, {"": get_default_qconfig(backend)})
+        with torch.no_grad():
+            for batch in calibration_batches:
+                model(batch)
+        return convert_fx(model)
+
     def _load_pretrained_model(self, pretrained_file):
-        pretrain_dict = torch.load(pretrained_file, map_location="cpu")
+        if not any(isinstance(m, nn.BatchNorm2d) for m in self.modules()):
+            raise RuntimeError(
+                "[MobileNetV2] Cannot load pretrained weights into a fused model; "
+                "load them before calling fuse_for_inference()"
+            )
+        pretrain_dict = load_checkpoint(pretrained_file, map_location="cpu")
+        if "state_dict" in pretrain_dict:
+            pretrain_dict = pretrain_dict["state_dict"]
         model_dict = {}
         state_dict = self.state_dict()
         print("[MobileNetV2] Loading pretrained model...")
@@ -193,17 +217,44 @@ class MobileNetV2(nn.Module):
         state_dict.update(model_dict)
         self.load_state_dict(state_dict)
 
+    def fuse_for_inference(self):
+        """
+        Fold every BatchNorm2d into its preceding Conv2d, in place
+
+        Covers conv_bn, conv_1x1_bn and InvertedResidual.conv; the folded
+        BatchNorm2d layers become Identity, so the model no longer accepts
+        unfused state_dicts. Eval mode only; call it explicitly once the
+        weights are loaded.
+        """
+        assert not self.training, "fuse_for_inference() requires eval mode"
+        modules_to_fuse = []
+        for name, module in self.named_modules():
+            if not isinstance(module, nn.Sequential):
+                continue
+            prefix = name + "." if name else ""
+            children = list(module.named_children())
+            for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                    modules_to_fuse.append([prefix + conv_name, prefix + bn_name])
+        fuse_modules(self, modules_to_fuse, inplace=True)
+        return self
+
     def _init_weights(self):
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2.0 / n))
-                if m.bias is not None:
-                    m.bias.data.zero_()
-            elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
-            elif isinstance(m, nn.Linear):
-                n = m.weight.size(1)
-                m.weight.data.normal_(0, 0.01)
-                m.bias.data.zero_()
+        zeros, ones = [], []
+        with torch.no_grad():
+            for m in self.modules():
+                if isinstance(m, nn.Conv2d):
+                    n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+                    m.weight.normal_(0, math.sqrt(2.0 / n))
+                    if m.bias is not None:
+                        zeros.append(m.bias)
+                elif isinstance(m, nn.BatchNorm2d):
+                    ones.append(m.weight)
+                    zeros.append(m.bias)
+                elif isinstance(m, nn.Linear):
+                    m.weight.normal_(0, 0.01)
+                    zeros.append(m.bias)
+
+            # Constant inits as multi-tensor kernels instead of one launch each
+            torch._foreach_zero_(zeros + ones)
+            torch._foreach_add_(ones, 1.0)
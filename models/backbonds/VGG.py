@@ -1,9 +1,10 @@
 # ------------------------------------------------------------------------------
 #   Libraries
 # ------------------------------------------------------------------------------
-import torch
 import torch.nn as nn
 
+from utils.checkpoint import load_checkpoint
+
 
 # ------------------------------------------------------------------------------
 #   Class of VGG
@@ -132,7 +133,9 @@ class VGG(nn.Module):
         return nn.Sequential(*layers)
 
     def _load_pretrained_model(self, pretrained_file):
-        pretrain_dict = torch.load(pretrained_file, map_location="cpu")
+        pretrain_dict = load_checkpoint(pretrained_file, map_location="cpu")
+        if "state_dict" in pretrain_dict:
+            pretrain_dict = pretrain_dict["state_dict"]
         model_dict = {}
         state_dict = self.state_dict()
         print("[VGG] Loading pretrained model...")
@@ -23,6 +23,9 @@ class StepLRScheduler(Scheduler):
         self.warmup_t = warmup_t
         self.warmup_lr_init = warmup_lr_init
         self.t_in_epochs = t_in_epochs
+        # decay factor only changes every decay_t steps; cache it per interval
+        self._last_decay_k = None
+        self._cached_lrs = None
         if self.warmup_t:
             self.warmup_steps = [
                 (v - warmup_lr_init) / self.warmup_t for v in self.base_values
@@ -35,9 +38,12 @@ class StepLRScheduler(Scheduler):
         if t < self.warmup_t:
             lrs = [self.warmup_lr_init + t * s for s in self.warmup_steps]
         else:
-            lrs = [
-                v * (self.decay_rate ** (t // self.decay_t)) for v in self.base_values
-            ]
+            k = t // self.decay_t
+            if k != self._last_decay_k:
+                factor = self.decay_rate ** k
+                self._cached_lrs = [v * factor for v in self.base_values]
+                self._last_decay_k = k
+            lrs = list(self._cached_lrs)
         return lrs
 
     def get_epoch_values(self, epoch: int):
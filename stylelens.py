@@ -21,6 +21,7 @@ from torch.nn import functional as F
 import style_model
 from base.base_inference import VideoInference
 from models import UNet
+from utils.checkpoint import load_checkpoint
 
 torch.inference_mode(True)
 
@@ -92,7 +93,7 @@ class SegModel:
         print("Loading Segmentation Network")
         self.segmentation_model = UNet(backbone="resnet18", num_classes=2)
         self.segmentation_model.cuda().eval()
-        trained_dict = torch.load(SEGMENTATION_NET_CHECKPOINT)["state_dict"]
+        trained_dict = load_checkpoint(SEGMENTATION_NET_CHECKPOINT)["state_dict"]
         self.segmentation_model.load_state_dict(trained_dict, strict=False)
 
         # Create segmentation object
@@ -1,9 +1,14 @@
 import argparse
+import concurrent.futures
+import heapq
+import itertools
+import os
 import queue
+import struct
 import sys
 import threading
 from dataclasses import dataclass
-from typing import Any, List, Union
+from typing import Any, Iterator, List, Optional, Sequence, Tuple, Union
 
 import cv2
 import json5
@@ -11,6 +16,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torchvision
+import torchvision.transforms.functional as TF
 
 import style_model
 
@@ -21,6 +27,14 @@ DECODER_CHECKPOINT = "model_checkpoints/decoder.pth"
 # Path of pretrained weights of transformer for style transfer
 TRANSFORMER_CHECKPOINT = "model_checkpoints/transformer.pth"
 
+# Number of style images encoded per batch when building the style cache
+STYLE_ENCODE_BATCH_SIZE = 32
+
+# Leading bytes of a JPEG file (SOI marker + first segment marker)
+JPEG_MAGIC = [0xFF, 0xD8, 0xFF]
+# EXIF tag holding the image orientation; 1 means stored upright
+EXIF_ORIENTATION_TAG = 0x0112
+
 
 class ModelRunner:
     device: torch.device
@@ -36,100 +50,102 @@ class ModelRunner:
 
 
 class Halt:
-    pass
+    """Sentinel type; compare against the HALT instance by identity."""
+
+
+HALT = Halt()
 
 
 def round_robin_model_runners(
     input_queue: queue.Queue,
     output_queue: queue.Queue,
     order: List[ModelRunner],
-    get_timeout: float = 0.005,
 ):
+    """
+    Fan jobs from input_queue out to the runners round-robin.
+
+    Results are put on output_queue in job order. If a job raises, the
+    exception is put on output_queue in that job's place and the other jobs
+    carry on. Put HALT on input_queue to stop; it is forwarded to
+    output_queue after the last result.
+    """
+
     def model_run(
         model_runner: ModelRunner,
         runner_input: queue.Queue,
-        runner_output: queue.Queue,
-        get_timeout: float,
+        results: queue.Queue,
     ):
         while True:
-            try:
-                job = runner_input.get(timeout=get_timeout)
-            except queue.Empty:
-                continue
+            item = runner_input.get()
+            if item is HALT:
+                break
 
-            if job == Halt:
-                runner_output.put(Halt)
+            seq, job = item
+            try:
+                result = model_runner.apply(**job)
+            except Exception as e:
+                # keep the sequence unbroken, or reassembly stalls for good
+                result = e
+            results.put((seq, result))
+
+    def collect_run(results: queue.Queue):
+        # runners finish out of order; reassemble by sequence number
+        next_seq = 0
+        pending: List[Tuple[int, Any]] = []
+        while True:
+            item = results.get()
+            if item is HALT:
                 break
 
-            runner_output.put(model_runner.apply(**job), block=True)
+            heapq.heappush(pending, item)
+            while pending and pending[0][0] == next_seq:
+                output_queue.put(heapq.heappop(pending)[1])
+                next_seq += 1
+
+        output_queue.put(HALT)
 
+    results: queue.Queue = queue.Queue()
     runner_threads = []
-    thread_input_queues = []
-    thread_output_queues = []
+    runner_input_queues = []
     for runner in order:
-        runner_input = queue.Queue()
-        runner_output = queue.Queue()
-        thread_input_queues.append(runner_input)
-        thread_output_queues.append(runner_output)
+        runner_input: queue.Queue = queue.Queue()
+        runner_input_queues.append(runner_input)
 
         runner_thread = threading.Thread(
             target=model_run,
             kwargs=dict(
                 model_runner=runner,
                 runner_input=runner_input,
-                runner_output=runner_output,
-                get_timeout=get_timeout,
+                results=results,
             ),
             daemon=True,
         )
         runner_threads.append(runner_thread)
         runner_thread.start()
 
-    def push_run():
-        idx = 0
-        while True:
-            try:
-                job = input_queue.get(timeout=get_timeout)
-            except queue.Empty:
-                continue
-
-            if job == Halt:
-                break
-
-            thread_input_queues[idx].put(job, block=True)
-            idx = (idx + 1) % len(thread_input_queues)
-
-    push_thread = threading.Thread(
-        target=push_run,
+    collect_thread = threading.Thread(
+        target=collect_run,
+        kwargs=dict(results=results),
         daemon=True,
     )
-    push_thread.start()
+    collect_thread.start()
 
-    def pull_run():
-        idx = 0
-        qs = thread_output_queues[:]
-        while qs:
-            try:
-                result = qs.get(timeout=get_timeout)
-            except queue.Empty:
-                continue
-
-            if result == Halt:
-                qs.remove(idx)
-            else:
-                output_queue.put(result, block=True)
-                idx = (idx + 1) % len(qs)
-
-    pull_thread = threading.Thread(
-        target=pull_run,
-        daemon=True,
-    )
-    pull_thread.start()
+    seq = 0
+    while True:
+        job = input_queue.get()
+        if job is HALT:
+            break
+
+        runner_input_queues[seq % len(runner_input_queues)].put((seq, job))
+        seq += 1
 
-    push_thread.join()
+    for runner_input in runner_input_queues:
+        runner_input.put(HALT)
     for t in runner_threads:
         t.join()
-    pull_thread.join()
+
+    results.put(HALT)
+    collect_thread.join()
 
 
 @dataclass
@@ -144,16 +160,39 @@ EncodedFrameOrTensor = Union[EncodedFrame, torch.Tensor]
 
 
 class StyleRunner(ModelRunner):
+    dtype: torch.dtype
+    use_cuda_graph: bool
     vgg: nn.Module
     transform: nn.Module
     decoder: nn.Module
 
+    def __init__(
+        self,
+        device: torch.device,
+        dtype: torch.dtype = torch.float16,
+        use_cuda_graph: bool = True,
+    ):
+        super().__init__(device)
+        self.dtype = dtype
+        self.use_cuda_graph = use_cuda_graph
+        self._graph = None
+
+    def _autocast(self) -> torch.autocast:
+        # keeps softmax and other precision-sensitive ops in float32; the
+        # weights are already in dtype, and the cast cache breaks graph capture
+        return torch.autocast(
+            device_type="cuda",
+            dtype=self.dtype,
+            enabled=self.dtype != torch.float32,
+            cache_enabled=False,
+        )
+
     @torch.inference_mode()
     def load(self) -> None:
         print(f"Loading transform style on device: {self.device}")
         self.vgg = style_model.make_vgg()
         self.vgg.load_state_dict(torch.load(VGG_CHECKPOINT))
-        self.vgg.cuda(self.device).eval()
+        self.vgg.to(self.device, self.dtype).eval()
 
         children = list(self.vgg.children())
         self.enc_1_to_4 = nn.Sequential(*children[:31])  # input -> relu4_1
@@ -163,30 +202,70 @@ class StyleRunner(ModelRunner):
 
         self.transform = style_model.Transform(in_planes=512)
         self.transform.load_state_dict(torch.load(TRANSFORMER_CHECKPOINT))
-        self.transform.cuda(self.device).eval()
+        self.transform.to(self.device, self.dtype).eval()
 
         self.decoder = style_model.make_decoder()
         self.decoder.load_state_dict(torch.load(DECODER_CHECKPOINT))
-        self.decoder.cuda(self.device).eval()
+        self.decoder.to(self.device, self.dtype).eval()
+
+        # Side stream for host->device and peer copies of incoming frames
+        self.copy_stream = torch.cuda.Stream(device=self.device)
+
+        # Run one frame through so the allocator pool is sized, and the
+        # 512x512 CUDA graph captured, at startup instead of on the first
+        # real frame.
+        warmup = torch.zeros(3, 512, 512, device=self.device)
+        self.apply(source=warmup, style=warmup)
+        torch.cuda.synchronize(self.device)
+
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Copy a tensor to this runner's device on the copy stream.
+
+        The copy is non_blocking (asynchronous for pinned host memory), and
+        the compute stream waits on it before any later kernel reads it.
+        """
+        compute_stream = torch.cuda.current_stream(self.device)
+        if tensor.device == compute_stream.device:
+            return tensor
+
+        if tensor.is_cuda:
+            # wait for whatever produced the source on its own device
+            self.copy_stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(self.copy_stream):
+            tensor = tensor.to(self.device, non_blocking=True)
+        compute_stream.wait_stream(self.copy_stream)
+        tensor.record_stream(compute_stream)
+        return tensor
 
     @torch.inference_mode()
     def encode_frame(self, source: EncodedFrameOrTensor) -> EncodedFrame:
         if isinstance(source, EncodedFrame):
-            if source.e4.device == self.device:
-                return source
-            else:
-                return EncodedFrame(
-                    e4=torch.as_tensor(source.e4, device=self.device).detach(),
-                    e5=torch.as_tensor(source.e5, device=self.device).detach(),
-                )
+            return EncodedFrame(
+                e4=self._to_device(source.e4).to(self.dtype).detach(),
+                e5=self._to_device(source.e5).to(self.dtype).detach(),
+            )
 
-        source = torch.as_tensor(source, device=self.device).detach()
+        source = self._to_device(torch.as_tensor(source)).to(self.dtype).detach()
 
-        e4 = self.enc_1_to_4(source.unsqueeze(0)).detach()
-        e5 = self.enc_5(e4).detach()
+        with self._autocast():
+            e4 = self.enc_1_to_4(source.unsqueeze(0)).detach()
+            e5 = self.enc_5(e4).detach()
 
         return EncodedFrame(e4, e5)
 
+    @torch.inference_mode()
+    def encode_batch(self, sources: Sequence[torch.Tensor]) -> List[EncodedFrame]:
+        """Encode [3, H, W] frames in one batched pass, one EncodedFrame each."""
+        batch = torch.stack([self._to_device(source) for source in sources])
+        batch = batch.to(self.dtype)
+
+        with self._autocast():
+            e4 = self.enc_1_to_4(batch).detach()
+            e5 = self.enc_5(e4).detach()
+
+        return [EncodedFrame(*pair) for pair in zip(e4.split(1), e5.split(1))]
+
     @torch.inference_mode()
     def apply(
         self,
@@ -197,17 +276,70 @@ class StyleRunner(ModelRunner):
         source = self.encode_frame(source)
         style = self.encode_frame(style)
 
-        t = self.transform(
-            source.e4,
-            style.e4,
-            source.e5,
-            style.e5,
-        )
+        inputs = (source.e4, style.e4, source.e5, style.e5)
+        if self.use_cuda_graph:
+            out = self._replay_transform_decode(inputs)
+        else:
+            out = self._transform_decode(*inputs)
+
+        return out.squeeze().float().detach()
+
+    def _transform_decode(
+        self,
+        source_e4: torch.Tensor,
+        style_e4: torch.Tensor,
+        source_e5: torch.Tensor,
+        style_e5: torch.Tensor,
+    ) -> torch.Tensor:
+        with self._autocast():
+            t = self.transform(source_e4, style_e4, source_e5, style_e5)
+            return self.decoder(t)
 
-        return self.decoder(t).squeeze().detach()
+    def _replay_transform_decode(
+        self,
+        inputs: Tuple[torch.Tensor, ...],
+    ) -> torch.Tensor:
+        """
+        Run transform + decoder by replaying a captured CUDA graph.
+
+        The graph is captured on the first call (the load() warmup, for
+        512x512 frames) against static input buffers; calls with other
+        shapes run eagerly.
+        """
+        shapes = tuple(t.shape for t in inputs)
+        if self._graph is not None and shapes != self._graph_shapes:
+            return self._transform_decode(*inputs)
+
+        # CUDAGraph, its capture stream and replay all bind to the current
+        # device, which is not this runner's device in general.
+        with torch.cuda.device(self.device):
+            compute_stream = torch.cuda.current_stream(self.device)
+            if self._graph is None:
+                self._graph_inputs = [t.clone() for t in inputs]
+                self._graph_shapes = shapes
+
+                # capture requires the kernels to have run once off the main
+                # stream; the same side stream is then used for the capture
+                capture_stream = torch.cuda.Stream(device=self.device)
+                capture_stream.wait_stream(compute_stream)
+                with torch.cuda.stream(capture_stream):
+                    for _ in range(3):
+                        self._transform_decode(*self._graph_inputs)
+                compute_stream.wait_stream(capture_stream)
+
+                self._graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(self._graph, stream=capture_stream):
+                    self._graph_output = self._transform_decode(*self._graph_inputs)
+
+            for buf, t in zip(self._graph_inputs, inputs):
+                buf.copy_(t)
+            self._graph.replay()
+            # the next replay overwrites the static output
+            return self._graph_output.to(torch.float32, copy=True)
 
 
 def central_square_crop(img: np.ndarray) -> np.ndarray:
+    """Central square of img, as a view (no pixel copy)."""
     center = (img.shape[0] / 2, img.shape[1] / 2)
     h = w = min(img.shape[0], img.shape[1])
     x = center[1] - w / 2
@@ -216,16 +348,107 @@ def central_square_crop(img: np.ndarray) -> np.ndarray:
     return crop_img
 
 
-def load_image_for_style(path: str) -> torch.Tensor:
-    img = cv2.imread(path)
-    img = central_square_crop(img)
-    img = cv2.resize(img, (512, 512))
+def jpeg_exif_orientation(data: bytes) -> int:
+    """EXIF Orientation of a JPEG file's bytes, or 1 if it has none."""
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker in (0xD9, 0xDA):
+            # end of image / start of scan: no metadata past this point
+            break
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        segment = data[pos + 4 : pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            tiff = segment[6:]
+            try:
+                endian = {b"II": "<", b"MM": ">"}[tiff[:2]]
+                (ifd,) = struct.unpack_from(endian + "I", tiff, 4)
+                (count,) = struct.unpack_from(endian + "H", tiff, ifd)
+                for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+                    tag, _, _, value = struct.unpack_from(endian + "HHIH", tiff, entry)
+                    if tag == EXIF_ORIENTATION_TAG:
+                        return value
+            except (KeyError, struct.error):
+                pass
+            return 1
+        pos += 2 + length
+    return 1
+
+
+def load_image_for_style(
+    path: str,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """
+    Load a style image as a [3, 512, 512] float RGB tensor in [0, 1].
+
+    When device is a CUDA device, JPEGs are decoded with nvjpeg and cropped
+    and resized on that device; other images go through OpenCV on the CPU.
+    nvjpeg ignores the EXIF Orientation tag that cv2.imread applies, so
+    rotated JPEGs, and any that nvjpeg fails to decode, use OpenCV too.
+    """
+    if device is not None and device.type == "cuda":
+        raw = torchvision.io.read_file(path)
+        if (
+            raw[:3].tolist() == JPEG_MAGIC
+            and jpeg_exif_orientation(raw.numpy().tobytes()) == 1
+        ):
+            try:
+                img = torchvision.io.decode_jpeg(
+                    raw,
+                    mode=torchvision.io.ImageReadMode.RGB,
+                    device=device,
+                )
+            except RuntimeError:
+                img = None
+            if img is not None:
+                img = TF.center_crop(img, [min(img.shape[-2:])] * 2)
+                img = TF.resize(img, [512, 512], antialias=True)
+                return img.float().div_(255)
+
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    # The crop is a strided view, so the resize reads the square ROI straight
+    # out of the decoded image; INTER_AREA averages source pixels, matching
+    # the antialiased resize on the GPU path.
+    img = cv2.resize(
+        central_square_crop(img),
+        (512, 512),
+        interpolation=cv2.INTER_AREA,
+    )
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    return torchvision.transforms.functional.to_tensor(img)
+    img = TF.to_tensor(img)
+    if torch.cuda.is_available():
+        # pinned memory lets the host->device copy run asynchronously
+        img = img.pin_memory()
+    return img
+
+
+def prefetch_style_images(
+    paths: List[str],
+    device: Optional[torch.device] = None,
+) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    Yield (path, image) pairs, loading the next image on a worker thread.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        for path in paths:
+            future = pool.submit(load_image_for_style, path, device)
+            if pending is not None:
+                yield pending[0], pending[1].result()
+            pending = (path, future)
+        if pending is not None:
+            yield pending[0], pending[1].result()
 
 
 @torch.inference_mode()
 def main(argv):
+    # Use the stream-ordered cudaMallocAsync pool for all runners; this must
+    # happen before the first CUDA allocation. torch < 2.0 rejects the
+    # backend option, so only set it where it is understood.
+    if torch.__version__ >= (2, 0):
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "backend:cudaMallocAsync")
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -234,6 +457,12 @@ def main(argv):
         help="Style devices",
         default=["cuda"],
     )
+    parser.add_argument(
+        "--style_dtype",
+        choices=["float16", "bfloat16", "float32"],
+        help="Style network weight / activation dtype",
+        default="float16",
+    )
     parser.add_argument(
         "--style_config",
         type=str,
@@ -249,7 +478,7 @@ def main(argv):
 
     style_runners = {}
     for name, device in style_devices.items():
-        runner = StyleRunner(device)
+        runner = StyleRunner(device, dtype=getattr(torch, args.style_dtype))
         runner.load()
         style_runners[name] = runner
 
@@ -262,13 +491,23 @@ def main(argv):
         ) from e
 
     print("Loading cached styles")
+    # Styles are encoded once on the primary device; the other devices get
+    # peer copies of the encoded frames rather than re-running the encoder.
+    primary_name, primary_device = next(iter(style_devices.items()))
+    primary_runner = style_runners[primary_name]
+    style_images = prefetch_style_images(style_config["styles"], device=primary_device)
     style_device_map = {}
-    for style_path in style_config["styles"]:
-        style_tensor = load_image_for_style(style_path)
-        style_device_map[style_path] = {
-            name: style_runners[name].encode_frame(style_tensor)
-            for name, device in style_devices.items()
-        }
+    while True:
+        chunk = list(itertools.islice(style_images, STYLE_ENCODE_BATCH_SIZE))
+        if not chunk:
+            break
+
+        style_paths, style_tensors = zip(*chunk)
+        frames = primary_runner.encode_batch(style_tensors)
+        for style_path, frame in zip(style_paths, frames):
+            style_device_map[style_path] = {
+                name: style_runners[name].encode_frame(frame) for name in style_devices
+            }
     print(style_runners)
 
 
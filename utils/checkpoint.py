@@ -0,0 +1,168 @@
+# ------------------------------------------------------------------------------
+#   Libraries
+# ------------------------------------------------------------------------------
+import ctypes
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from typing import Any, Tuple
+
+import torch
+
+# ------------------------------------------------------------------------------
+#   Coalesced checkpoint format
+#
+#   [prelude: magic, header length, data offset]
+#   [header: pickled state with every tensor replaced by a TensorRef]
+#   [payload: raw tensor bytes, each tensor starting on an ALIGNMENT boundary]
+# ------------------------------------------------------------------------------
+MAGIC = b"SLCKPT01"
+ALIGNMENT = 4096
+# Maximum number of buffers handed to a single writev() call
+MAX_INFLIGHT_WRITES = 64
+
+_PRELUDE = struct.Struct("<8sQQ")
+_ZEROS = bytes(ALIGNMENT)
+
+
+@dataclass(frozen=True)
+class TensorRef:
+    """Placeholder for a tensor stored in the checkpoint payload."""
+
+    offset: int
+    nbytes: int
+    dtype: str
+    shape: Tuple[int, ...]
+
+
+def _align(n: int) -> int:
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _map_tensors(obj: Any, fn) -> Any:
+    if isinstance(obj, (torch.Tensor, TensorRef)):
+        return fn(obj)
+    if isinstance(obj, dict):
+        mapped = type(obj)((k, _map_tensors(v, fn)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            mapped._metadata = obj._metadata
+        return mapped
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(v, fn) for v in obj)
+    return obj
+
+
+def _writev_all(fd: int, buffers: list) -> None:
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    idx = 0
+    while idx < len(buffers):
+        written = os.writev(fd, buffers[idx : idx + MAX_INFLIGHT_WRITES])
+        while written:
+            n = len(buffers[idx])
+            if written >= n:
+                written -= n
+                idx += 1
+            else:
+                buffers[idx] = buffers[idx][written:]
+                written = 0
+
+
+# ------------------------------------------------------------------------------
+#   Save / load
+# ------------------------------------------------------------------------------
+def save_checkpoint(state: Any, path: str) -> None:
+    """
+    Write a checkpoint as a small pickled header plus aligned tensor payloads
+
+    The header is pickled once, and tensor bytes are written straight from
+    tensor memory in batches of up to MAX_INFLIGHT_WRITES buffers per
+    writev() call, instead of the many small writes torch.save issues.
+
+    :param state: checkpoint object; tensors may be nested in dicts/lists/tuples
+    The bytes go to a temporary file in the same directory, which is fsynced
+    and then renamed onto path, so an existing checkpoint is only ever
+    replaced by a complete one.
+
+    :param path: output file path
+    """
+    tensors = []
+    offset = 0
+
+    def to_ref(tensor):
+        nonlocal offset
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        ref = TensorRef(offset, nbytes, str(tensor.dtype), tuple(tensor.shape))
+        tensors.append(tensor)
+        offset = _align(offset + nbytes)
+        return ref
+
+    header = pickle.dumps(_map_tensors(state, to_ref), protocol=pickle.HIGHEST_PROTOCOL)
+    data_offset = _align(_PRELUDE.size + len(header))
+
+    buffers = [
+        _PRELUDE.pack(MAGIC, len(header), data_offset),
+        header,
+        _ZEROS[: data_offset - _PRELUDE.size - len(header)],
+    ]
+    for tensor in tensors:
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes:
+            buffers.append((ctypes.c_char * nbytes).from_address(tensor.data_ptr()))
+        buffers.append(_ZEROS[: _align(nbytes) - nbytes])
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".{}.".format(basename))
+    try:
+        try:
+            os.fchmod(fd, 0o644)
+            _writev_all(fd, buffers)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_checkpoint(path: str, map_location=None) -> Any:
+    """
+    Load a checkpoint written by save_checkpoint() or by torch.save()
+
+    Coalesced checkpoints are always loaded onto the CPU, with tensors backed
+    by a private memory map of the file so their pages are only read when
+    touched. map_location only applies to checkpoints in the torch.save()
+    format, which are memory-mapped too on torch >= 2.1 when saved in the
+    zipfile serialization (legacy pickle-format files are read normally).
+
+    :param path: checkpoint file path
+    :param map_location: passed to torch.load for torch.save() checkpoints
+    """
+    with open(path, "rb") as f:
+        prelude = f.read(_PRELUDE.size)
+        if len(prelude) < _PRELUDE.size or prelude[:8] != MAGIC:
+            # mmap only supports the zipfile serialization, not legacy pickles
+            use_mmap = torch.__version__ >= (2, 1) and zipfile.is_zipfile(path)
+            kwargs = {"mmap": True} if use_mmap else {}
+            return torch.load(path, map_location=map_location, **kwargs)
+
+        _, header_len, data_offset = _PRELUDE.unpack(prelude)
+        state = pickle.loads(f.read(header_len))
+        # copy-on-write, so the tensors are writable without touching the file
+        payload = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def from_ref(ref):
+        dtype = getattr(torch, ref.dtype.split(".")[-1])
+        if ref.nbytes == 0:
+            return torch.empty(ref.shape, dtype=dtype)
+        count = ref.nbytes // torch.empty((), dtype=dtype).element_size()
+        return torch.frombuffer(
+            payload, dtype=dtype, count=count, offset=data_offset + ref.offset
+        ).reshape(ref.shape)
+
+    return _map_tensors(state, from_ref)
@@ -0,0 +1,31 @@
+# ------------------------------------------------------------------------------
+#   Libraries
+# ------------------------------------------------------------------------------
+import os
+
+
+# ------------------------------------------------------------------------------
+#   Launch environment
+#
+#   Read from the variables set by torchrun (or by a torch.multiprocessing.spawn
+#   entry point that sets them), so they are usable before the process group
+#   is initialized, e.g. while building data loaders.
+# ------------------------------------------------------------------------------
+def get_world_size() -> int:
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def get_rank() -> int:
+    return int(os.environ.get("RANK", 0))
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_distributed() -> bool:
+    return get_world_size() > 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0